@@ -14,11 +14,10 @@ Features:
 
 import os
 import sys
-import shutil
-import argparse
 import datetime
 import re
-import xml.etree.ElementTree as ET
+import threading
+import functools
 
 # Constants (edit if your paths differ)
 SYMBOLS_FILE = '/usr/share/X11/xkb/symbols/us'
@@ -32,8 +31,75 @@ SYMBOLS_END   = '# DPE-END'
 XML_START     = 'DPE-START'
 XML_END       = 'DPE-END'
 
-
+# Compiled once; matches the injected block inclusive of its markers
+_SYM_BLOCK_RE = re.compile(
+    r"\n?" + re.escape(SYMBOLS_START) + r".*?" + re.escape(SYMBOLS_END) + r"\n?", re.DOTALL)
+_XML_BLOCK_RE = re.compile(
+    re.escape(f'<!--{XML_START}-->') + r".*?" + re.escape(f'<!--{XML_END}-->'), re.DOTALL)
+
+# Marker-wrapped variant block spliced into evdev.xml; the name and
+# description are fixed, so build (and encode) it once at import. Every
+# byte, including the layout whitespace, sits inside the markers so that
+# removing START..END inclusive restores the file exactly
+_VARIANT_INSERT = (
+    f"<!--{XML_START}--><variant>\n"
+    "          <configItem>\n"
+    "            <name>dpe</name>\n"
+    "            <description>English (Programmer Dvorak Eur. Keys)</description>\n"
+    "          </configItem>\n"
+    f"        </variant>\n        <!--{XML_END}-->"
+).encode()
+
+
+# File contents keyed by path, validated against mtime/size so a run that
+# touches the same file several times (marker check, edit, re-check) reads
+# it from disk only once
+_read_cache = {}
+
+# Serializes output from the two worker threads in main()
+_print_lock = threading.Lock()
+
+
+def say(msg):
+    with _print_lock:
+        print(msg)
+
+
+def read_cached(path):
+    st = os.stat(path)
+    sig = (st.st_mtime_ns, st.st_size)
+    hit = _read_cache.get(path)
+    if hit is not None and hit[0] == sig:
+        return hit[1]
+    text = open(path).read()
+    _read_cache[path] = (sig, text)
+    return text
+
+
+def write_atomic(path, text):
+    # write to a sibling tmp file and rename over the original, so a crash
+    # mid-write can never leave a truncated symbols/rules file behind
+    import shutil
+    tmp = path + '.tmp'
+    if isinstance(text, str):
+        text = text.encode()
+    # one write(2) for the whole buffer instead of buffered fragments
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(text)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    shutil.copymode(path, tmp)
+    os.replace(tmp, path)
+
+
+@functools.lru_cache(maxsize=None)
 def ensure_backup_dir():
+    # memoized: backup() and list_backups() all call this, but one stat/mkdir
+    # per process is enough
     os.makedirs(BACKUP_DIR, exist_ok=True)
 
 
@@ -42,120 +108,176 @@ def timestamp():
 
 
 def backup(path):
+    import shutil
     ensure_backup_dir()
     fname = os.path.basename(path) + '.' + timestamp() + '.bak'
     dest = os.path.join(BACKUP_DIR, fname)
-    shutil.copy2(path, dest)
-    print(f'Backup of {path} → {dest}')
+    try:
+        # in-kernel copy; on Btrfs/XFS this is a reflink and moves no data.
+        # A hardlink would be even cheaper but shares the inode with a file
+        # we later rewrite, which would corrupt the backup.
+        with open(path, 'rb') as src, open(dest, 'wb') as dst:
+            remaining = os.fstat(src.fileno()).st_size
+            while remaining > 0:
+                n = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                if n == 0:
+                    raise OSError('copy_file_range copied nothing')
+                remaining -= n
+        shutil.copystat(path, dest)
+    except OSError:
+        shutil.copy2(path, dest)
+    say(f'Backup of {path} → {dest}')
     return dest
 
 
+# Sorted backup listings keyed by directory mtime, so repeated calls in the
+# same process (e.g. from a wrapper UI) skip the listdir syscalls
+_ls_cache = {}
+
+
 def list_backups():
     ensure_backup_dir()
-    for f in sorted(os.listdir(BACKUP_DIR)):
-        print(f)
+    st = os.stat(BACKUP_DIR)
+    hit = _ls_cache.get(BACKUP_DIR)
+    if hit is not None and hit[0] == st.st_mtime_ns:
+        files = hit[1]
+    else:
+        files = sorted(os.listdir(BACKUP_DIR))
+        _ls_cache[BACKUP_DIR] = (st.st_mtime_ns, files)
+    if files:
+        sys.stdout.write('\n'.join(files) + '\n')
 
 
 def install_symbols():
-    data = open(SYMBOLS_FILE).read()
+    data = read_cached(SYMBOLS_FILE)
     if SYMBOLS_START in data:
-        print('Symbols file already contains DPE section; skipping.')
+        say('Symbols file already contains DPE section; skipping.')
         return
     backup(SYMBOLS_FILE)
 
-    layout = open(LAYOUT_FILE).read().rstrip()
-    injected = (
-        "\n" + SYMBOLS_START + "\n"
-        + layout + "\n"
-        + SYMBOLS_END + "\n"
-    )
-    with open(SYMBOLS_FILE, 'a') as f:
-        f.write(injected)
-    print('Injected layout into symbols file.')
+    # copy the layout file in kernel space instead of bouncing it through a
+    # Python string; sendfile refuses O_APPEND targets, so seek to the end
+    import shutil
+    with open(SYMBOLS_FILE, 'r+b') as dst:
+        dst.seek(0, os.SEEK_END)
+        dst.write(f'\n{SYMBOLS_START}\n'.encode())
+        dst.flush()
+        with open(LAYOUT_FILE, 'rb') as src:
+            size = os.fstat(src.fileno()).st_size
+            sent = 0
+            try:
+                # sendfile may transfer fewer bytes than asked; loop on the
+                # returned count like backup() does for copy_file_range
+                while sent < size:
+                    n = os.sendfile(dst.fileno(), src.fileno(), sent,
+                                    size - sent)
+                    if n == 0:
+                        raise OSError('sendfile copied nothing')
+                    sent += n
+            except OSError:
+                if sent:
+                    # partial copy already landed; don't paper over it by
+                    # appending a second copy from the start
+                    raise
+                shutil.copyfileobj(src, dst)
+                dst.flush()
+        dst.seek(0, os.SEEK_END)
+        dst.write(f'{SYMBOLS_END}\n'.encode())
+    _read_cache.pop(SYMBOLS_FILE, None)
+    say('Injected layout into symbols file.')
 
 
 def uninstall_symbols():
-    text = open(SYMBOLS_FILE).read()
+    text = read_cached(SYMBOLS_FILE)
     if SYMBOLS_START not in text:
-        print('No DPE markers in symbols file; skipping.')
+        say('No DPE markers in symbols file; skipping.')
+        return
+    # remove block between markers inclusive; only touch the file if the
+    # substitution actually changed something (a lone marker matches nothing)
+    new = _SYM_BLOCK_RE.sub('', text, count=1)
+    if new == text:
+        say('DPE block in symbols file is malformed; nothing removed.')
         return
     backup(SYMBOLS_FILE)
-    # remove block between markers inclusive
-    new = re.sub(rf"{re.escape(SYMBOLS_START)}[\s\S]*?{re.escape(SYMBOLS_END)}\n?", '', text)
-    with open(SYMBOLS_FILE, 'w') as f:
-        f.write(new)
-    print('Removed layout from symbols file.')
+    write_atomic(SYMBOLS_FILE, new)
+    _read_cache.pop(SYMBOLS_FILE, None)
+    say('Removed layout from symbols file.')
 
 
 def install_variant():
-    text = open(RULES_FILE).read()
-    if f'<!--{XML_START}-->' in text:
-        print('Variant already installed; skipping.')
-        return
-    backup(RULES_FILE)
-
-    parser = ET.XMLParser(target=ET.TreeBuilder(insert_comments=True))
-    tree = ET.parse(RULES_FILE, parser=parser)
-    root = tree.getroot()
-
-    us_layout = None
-    for layout in root.findall('.//layout'):
-        ci = layout.find('configItem')
-        if ci is not None and (ci.find('name') is not None and ci.find('name').text == 'us'):
-            # ensure shortDescription=en and countryList contains US
-            sd = ci.find('shortDescription')
-            if sd is not None and sd.text == 'en':
-                us_layout = layout
-                break
-    if us_layout is None:
-        print('Could not find US layout in rules file.')
-        sys.exit(1)
-
-    vlist = us_layout.find('variantList')
-    if vlist is None:
-        print('No <variantList> under US layout; cannot install.')
-        sys.exit(1)
-
-    variant = ET.Element('variant')
-    ci = ET.SubElement(variant, 'configItem')
-    nm = ET.SubElement(ci, 'name'); nm.text = 'dpe'
-    desc = ET.SubElement(ci, 'description')
-    desc.text = 'English (Programmer Dvorak Eur. Keys)'
-
-    vlist.append(ET.Comment(XML_START))
-    vlist.append(variant)
-    vlist.append(ET.Comment(XML_END))
-
-    tree.write(RULES_FILE, encoding='utf-8', xml_declaration=True)
-    print('Injected variant into evdev.xml.')
+    import mmap
+    # scan the rules file through an mmap: the kernel page cache backs the
+    # view, and the byte-level find skips decoding the whole file to str
+    with open(RULES_FILE, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm.find(f'<!--{XML_START}-->'.encode()) != -1:
+                say('Variant already installed; skipping.')
+                return
+            backup(RULES_FILE)
+
+            # locate the </variantList> that closes the "us" layout and
+            # splice the variant block in just before it; no need to parse
+            # the whole document
+            idx = mm.find(b'<name>us</name>')
+            if idx == -1:
+                say('Could not find US layout in rules file.')
+                sys.exit(1)
+            close = mm.find(b'</variantList>', idx)
+            if close == -1:
+                say('No <variantList> under US layout; cannot install.')
+                sys.exit(1)
+
+            new = mm[:close] + _VARIANT_INSERT + mm[close:]
+    write_atomic(RULES_FILE, new)
+    _read_cache.pop(RULES_FILE, None)
+    say('Injected variant into evdev.xml.')
 
 
 def uninstall_variant():
-    text = open(RULES_FILE).read()
+    text = read_cached(RULES_FILE)
     if f'<!--{XML_START}-->' not in text:
-        print('No variant markers found in rules file.')
+        say('No variant markers found in rules file.')
+        return
+    # remove XML comment block inclusive; skip the backup and rewrite when
+    # the markers turn out not to match (nothing would change on disk)
+    new = _XML_BLOCK_RE.sub('', text, count=1)
+    if new == text:
+        say('DPE block in rules file is malformed; nothing removed.')
         return
     backup(RULES_FILE)
-    # remove XML comment block inclusive
-    new = re.sub(rf"<!--{XML_START}-->[\s\S]*?<!--{XML_END}-->", '', text)
-    with open(RULES_FILE, 'w') as f:
-        f.write(new)
-    print('Removed variant from evdev.xml.')
+    write_atomic(RULES_FILE, new)
+    _read_cache.pop(RULES_FILE, None)
+    say('Removed variant from evdev.xml.')
+
+
+def install():
+    # the two edits touch different files; overlap their I/O
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        futures = [ex.submit(install_symbols), ex.submit(install_variant)]
+        for fut in futures:
+            fut.result()
+
+
+def uninstall():
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        futures = [ex.submit(uninstall_symbols), ex.submit(uninstall_variant)]
+        for fut in futures:
+            fut.result()
 
 
 def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('cmd', choices=['install','uninstall','list-backups'])
-    args = parser.parse_args()
-
-    if args.cmd == 'list-backups':
-        list_backups()
-    elif args.cmd == 'install':
-        install_symbols()
-        install_variant()
-    elif args.cmd == 'uninstall':
-        uninstall_symbols()
-        uninstall_variant()
+    dispatch = {
+        'install': install,
+        'uninstall': uninstall,
+        'list-backups': list_backups,
+    }
+    cmd = sys.argv[1] if len(sys.argv) > 1 else ''
+    fn = dispatch.get(cmd)
+    if fn is None:
+        sys.exit(f"usage: {sys.argv[0]} {{{','.join(dispatch)}}}")
+    fn()
 
 if __name__ == '__main__':
     main()